@@ -0,0 +1,332 @@
+"""Tests for trac2issues, run with: python -m pytest tests
+
+Database backends and HTTP servers that aren't available here are
+replaced by stand-ins recording how they're used.
+"""
+
+import os
+import socket
+import sys
+import threading
+import urllib2
+
+# trac2issues parses the command line when imported.
+sys.argv = sys.argv[:1]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import trac2issues
+
+import pytest
+
+
+COMMENTS = "select ticket, time, newvalue from ticket_change where field = %s order by ticket, time"
+
+
+@pytest.fixture
+def db(tmpdir):
+    # 200 tickets with 5 comments each.
+    return trac2issues.create_synthetic_trac_db(str(tmpdir.join('trac.db')), 200, 5)
+
+
+class Cursor(object):
+    """A DB-API cursor over sqlite, logging fetches and closing."""
+
+    def __init__(self, db, log):
+        self.cursor = db.cursor()
+        self.log = log
+
+    def execute(self, sql, args):
+        self.cursor.execute(sql.replace('%s', '?'), args)
+
+    def fetchmany(self, size):
+        self.log.append(('fetchmany', size))
+        return self.cursor.fetchmany(size)
+
+    def close(self):
+        self.log.append(('close', 'cursor'))
+
+
+class PostgresConnection(object):
+    """Looks like a psycopg2 connection to TracDatabase."""
+
+    autocommit = True
+
+    def __init__(self, db, log):
+        self.db = db
+        self.log = log
+
+    def cursor(self, name=None, withhold=False):
+        self.log.append(('cursor', name, withhold))
+        return Cursor(self.db, self.log)
+
+PostgresConnection.__module__ = 'psycopg2.extensions'
+
+
+class SSCursor(object):
+    pass
+
+
+class MySQLConnection(object):
+    """Looks like a MySQLdb connection to TracDatabase."""
+
+    def __init__(self, db, log):
+        self.db = db
+        self.log = log
+
+    def cursor(self, cursorclass=None):
+        self.log.append(('cursor', cursorclass))
+        return Cursor(self.db, self.log)
+
+    def close(self):
+        self.log.append(('close', 'connection'))
+
+MySQLConnection.__module__ = 'MySQLdb.connections'
+
+
+@pytest.fixture
+def mysqldb(monkeypatch):
+    """A stand-in MySQLdb package, with cursors.SSCursor."""
+    module = type(sys)('MySQLdb')
+    module.cursors = type(sys)('MySQLdb.cursors')
+    module.cursors.SSCursor = SSCursor
+    monkeypatch.setitem(sys.modules, 'MySQLdb', module)
+    monkeypatch.setitem(sys.modules, 'MySQLdb.cursors', module.cursors)
+    return module
+
+
+def test_stream_sqlite(db):
+    database = trac2issues.TracDatabase(db, fetch_size=7)
+    rows = list(database.stream(COMMENTS, ['comment']))
+    assert len(rows) == 1000
+    assert rows == sorted(rows)
+
+
+@pytest.mark.parametrize('fetch_size', [1000, 300, 7])
+def test_stream_postgres_uses_named_cursor(db, fetch_size):
+    log = []
+    database = trac2issues.TracDatabase(PostgresConnection(db, log), fetch_size=fetch_size)
+    assert database.backend == 'psycopg2'
+    assert len(list(database.stream(COMMENTS, ['comment']))) == 1000
+    # Declared WITH HOLD, since autocommit means there's no transaction.
+    assert log[0] == ('cursor', 'trac2issues_1', True)
+    fetches = [entry for entry in log if entry[0] == 'fetchmany']
+    # Full batches, then an empty one to end on.
+    assert fetches == [('fetchmany', fetch_size)] * (-(-1000 // fetch_size) + 1)
+    assert log[-1] == ('close', 'cursor')
+
+    # Each stream gets a cursor of its own.
+    del log[:]
+    list(database.stream(COMMENTS, ['comment']))
+    assert log[0] == ('cursor', 'trac2issues_2', True)
+
+
+def test_stream_postgres_without_autocommit(db):
+    log = []
+    cnx = PostgresConnection(db, log)
+    cnx.autocommit = False
+    list(trac2issues.TracDatabase(cnx).stream(COMMENTS, ['comment']))
+    assert log[0] == ('cursor', 'trac2issues_1', False)
+
+
+def test_stream_mysql_uses_own_connection(db, mysqldb):
+    log = []
+    connections = []
+
+    def connect():
+        connections.append(MySQLConnection(db, log))
+        return connections[-1]
+
+    main = MySQLConnection(db, log)
+    database = trac2issues.TracDatabase(main, connect, fetch_size=300)
+    assert len(list(database.stream(COMMENTS, ['comment']))) == 1000
+    assert len(connections) == 1 and connections[0] is not main
+    assert log[0] == ('cursor', SSCursor)
+    assert [entry for entry in log if entry[0] == 'fetchmany'] == [('fetchmany', 300)] * 5
+    assert log[-2:] == [('close', 'cursor'), ('close', 'connection')]
+
+
+@pytest.mark.parametrize('backend', ['postgres', 'mysql'])
+def test_stream_cleans_up_when_stopped_early(db, mysqldb, backend):
+    log = []
+    if backend == 'postgres':
+        database = trac2issues.TracDatabase(PostgresConnection(db, log))
+    else:
+        database = trac2issues.TracDatabase(MySQLConnection(db, log),
+                                            lambda: MySQLConnection(db, log))
+    stream = database.stream(COMMENTS, ['comment'])
+    next(stream)
+    stream.close()
+    assert ('close', 'cursor') in log
+    if backend == 'mysql':
+        assert log[-1] == ('close', 'connection')
+
+
+class Server(object):
+    """An HTTP/1.1 server on a raw socket, answering each request with
+    respond(method, path), and closing connections left idle for
+    idle_timeout seconds. A response of None drops the connection
+    without answering."""
+
+    def __init__(self, respond, idle_timeout=1.0):
+        self.respond = respond
+        self.idle_timeout = idle_timeout
+        self.requests = []
+        self.connections = 0
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.url = 'http://127.0.0.1:%d' % self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            conn, address = self.sock.accept()
+            self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        conn.settimeout(self.idle_timeout)
+        reader = conn.makefile()
+        try:
+            while True:
+                line = reader.readline()
+                if not line:
+                    break
+                headers = {}
+                while True:
+                    header = reader.readline()
+                    if header in ('\r\n', '\n', ''):
+                        break
+                    name, value = header.split(':', 1)
+                    headers[name.lower()] = value.strip()
+                reader.read(int(headers.get('content-length', 0)))
+                method, path = line.split()[:2]
+                self.requests.append((method, path))
+                response = self.respond(method, path)
+                if response is None:
+                    break
+                status, body = response
+                conn.sendall('HTTP/1.1 %s\r\nContent-Length: %d\r\n\r\n%s'
+                             % (status, len(body), body))
+        except socket.timeout:
+            pass
+        finally:
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+
+
+def ok(method, path):
+    return '200 OK', 'ok'
+
+
+def test_pool_reuses_connections():
+    server = Server(ok)
+    pool = trac2issues.ConnectionPool()
+    for i in range(5):
+        assert pool.urlopen(server.url + '/x').read() == 'ok'
+    assert (pool.connections, pool.reused, server.connections) == (1, 4, 1)
+
+
+def test_pool_drops_connections_closed_while_idle():
+    server = Server(ok, idle_timeout=0.2)
+    pool = trac2issues.ConnectionPool()
+    pool.urlopen(urllib2.Request(server.url + '/a', data='{}'))
+    threading.Event().wait(0.5)
+    # The server has closed the connection; the POST must not be sent on it.
+    assert pool.urlopen(urllib2.Request(server.url + '/b', data='{}')).read() == 'ok'
+    assert server.requests == [('POST', '/a'), ('POST', '/b')]
+    assert server.connections == 2
+
+
+def test_pool_drops_connections_idle_too_long():
+    server = Server(ok, idle_timeout=10)
+    pool = trac2issues.ConnectionPool(idle_timeout=0.1)
+    pool.urlopen(server.url + '/a')
+    threading.Event().wait(0.3)
+    pool.urlopen(server.url + '/b')
+    assert (pool.connections, pool.reused) == (2, 0)
+
+
+def test_pool_never_resends_a_post():
+    def respond(method, path):
+        if path == '/drop':
+            return None
+        return ok(method, path)
+    server = Server(respond)
+    pool = trac2issues.ConnectionPool()
+    pool.urlopen(server.url + '/a')
+    with pytest.raises(trac2issues.ConnectionPool.stale_errors):
+        pool.urlopen(urllib2.Request(server.url + '/drop', data='{}'))
+    assert server.requests == [('GET', '/a'), ('POST', '/drop')]
+
+
+def test_pool_follows_redirects():
+    def respond(method, path):
+        if path == '/old':
+            return '307 Temporary Redirect\r\nLocation: /new', ''
+        return ok(method, path)
+    server = Server(respond)
+    response = trac2issues.ConnectionPool().urlopen(
+        urllib2.Request(server.url + '/old', data='{}'))
+    assert response.geturl() == server.url + '/new'
+    assert server.requests == [('POST', '/old'), ('POST', '/new')]
+
+
+def test_pool_uses_proxy(monkeypatch):
+    server = Server(ok)
+    monkeypatch.setenv('http_proxy', server.url)
+    monkeypatch.setenv('no_proxy', '')
+    assert trac2issues.ConnectionPool().urlopen('http://example.invalid/x').read() == 'ok'
+    assert server.requests == [('GET', 'http://example.invalid/x')]
+
+
+def test_fetch_tickets_batches_comments(db):
+    importer = trac2issues.ImportTickets(db=db)
+    importer.includeClosed = True
+    tickets = list(importer._fetchTickets())
+    assert [t['id'] for t in tickets] == range(1, 201)
+    for ticket in tickets:
+        assert [h['comment'] for h in ticket['history']] == [
+            "Comment %d on ticket %d with '''some''' text." % (j, ticket['id'])
+            for j in range(5)]
+
+
+class Headers(dict):
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+def test_rate_limiter_recovers_after_secondary_limit(monkeypatch):
+    limiter = trac2issues.RateLimiter(max_per_minute=600)
+    monkeypatch.setattr(trac2issues, 'bold', lambda text: text)
+    monkeypatch.setattr(trac2issues, '_error_body', lambda err: '')
+    err = urllib2.HTTPError('http://x', 403, 'Forbidden',
+                            Headers({'retry-after': '0'}), None)
+    assert limiter.throttle(err)
+    assert limiter.max_rate == 5
+    headers = Headers({'x-ratelimit-remaining': '5000',
+                       'x-ratelimit-reset': str(int(trac2issues.time.time()) + 3600)})
+    for i in range(100):
+        limiter.update(headers)
+    assert limiter.max_rate == 10
+
+
+def test_urlopen_retries_gets_on_server_errors(monkeypatch):
+    failures = {'GET': 2, 'POST': 2}
+
+    def respond(method, path):
+        if failures[method]:
+            failures[method] -= 1
+            return '502 Bad Gateway', ''
+        return ok(method, path)
+    server = Server(respond)
+    monkeypatch.setattr(trac2issues, 'rate_limiter', trac2issues.RateLimiter(10 ** 9))
+    monkeypatch.setattr(trac2issues.time, 'sleep', lambda seconds: None)
+    assert trac2issues.urlopen(server.url + '/a').read() == 'ok'
+    with pytest.raises(urllib2.HTTPError):
+        trac2issues.urlopen(urllib2.Request(server.url + '/b', data='{}'))
+    assert server.requests == [('GET', '/a')] * 3 + [('POST', '/b')]